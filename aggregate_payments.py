@@ -19,12 +19,12 @@ HOW IT WORKS:
 
 PROCESSES:
     1. get_file_name() to get the most recent unmodified file in the directory,
-    read_file() to read the contents into memory and create_payments() to
+    read_file() to stream the lines of the file and create_payments() to
     create the Payment objects.
     2. query_payments() to get or create the unique identifier for each Payment
-    object and group_payments() to create a dictionary using the unique
-    identifiers for keys.
-    3. sum_payments() to sum up the totals and create a new Payment object.
+    object.
+    3. sum_payments() to sum up the totals for each unique identifier and
+    create a new Payment object.
     4. write_new_payments() to write the new Payment objects back to the file.
     5. send_email() to send the email.
 
@@ -34,6 +34,8 @@ NOTES:
     * Each field in the file is wrapped in double quotes and may have trailing
     whitespace. The entries in the database don't have these characters, so
     they are removed when checking against and writing to the table.
+    * The PayeeKey table type and upsert_payees stored procedure in the sql
+    directory need to be created in the database before the first run.
 
 https://github.com/james-whitehead/PaymentAggregation
 """
@@ -44,57 +46,100 @@ import sys
 import json
 import shutil
 import smtplib
+from concurrent.futures import ThreadPoolExecutor
 from email.message import EmailMessage
+from itertools import islice
+from types import MappingProxyType
+from typing import Callable, Iterable, Iterator, Mapping, TextIO
 import pyodbc
 
+SYSTIME = datetime.date.today().strftime('%d-%b-%Y').upper()
+
+# The default value of every field in a BPY331 payment record, in the order
+# they appear in the file. Fields with "NOT SET" are variable and set with
+# details read from the file. Other fields are either static or can be set
+# right away.
+PAYMENT_DEFAULTS = MappingProxyType({
+    'interface_source': '"BEN"',
+    'batch_run_id': '"NOT SET"',
+    'posting_ref': '"NOT SET"',
+    'account_ref': '"NOT SET"',
+    'payee_type': '"CL"',
+    'payee_name': '"NOT SET"',
+    'payee_address': '"NOT SET"',
+    'claim_ref': '"NOT SET"',
+    'claimant_name': '"Aggregated DHP UC Payment"',
+    'claimant_adddress': '"Aggregated DHP UC Payment"',
+    'amount': '"amount"',
+    'posting_start_date': f'"{SYSTIME}"',
+    'posting_end_date': f'"{SYSTIME}"',
+    'payment_method': '"BACS"',
+    'creditor_account_ref': '""',
+    'sort_code': '"NOT SET"',
+    'bank_account': '"NOT SET"',
+    'bank_account_name': '"NOT SET"',
+    'building_society_num': '"NOT SET"',
+    'post_office_name': '""',
+    'post_office_address': '""',
+    'collection_flag': '"N"',
+    'document_num': '""',
+    'document_type': '""',
+    'replacement_flag': '"N"',
+    'effective_date': f'"{SYSTIME}"',
+    'blank_one': '""',
+    'blank_two': '""',
+    'document_date': '""'})
+
+# The source of Payment.__init__, with a keyword-only parameter and an
+# assignment for each field filled in by _generate_init()
+_INIT_TEMPLATE = '''def __init__(self, *, {parameters}) -> None:
+    """
+    Initialises a Payment object with the default values, overridden by
+    any that are given. Unknown fields raise a TypeError.
+    Args:
+        <field> (str): A keyword-only argument for each field in
+        PAYMENT_DEFAULTS, defaulting to its value there.
+    """
+{assignments}    # Caches the fields used for grouping, with surrounding quotes and
+    # trailing whitespace removed
+    self._key = (
+        self.bank_account[1:-2], self.sort_code[1:-2],
+        self.payee_name[1:-2], self.building_society_num[1:-2])
+'''
+
+def _generate_init(defaults: Mapping[str, str]) -> Callable[..., None]:
+    """
+    Generates an __init__ for Payment that takes each field as a keyword
+    argument and sets it with its own assignment, rather than looping over
+    the defaults and calling setattr() for every field of every record.
+    Args:
+        defaults (Mapping[str, str]): The default value of each field.
+    Returns:
+        (Callable[..., None]): The generated __init__ function.
+    """
+    parameters = ', '.join(
+        f'{key}: str = {value!r}' for key, value in defaults.items())
+    assignments = ''.join(f'    self.{key} = {key}\n' for key in defaults)
+    source = _INIT_TEMPLATE.format(
+        parameters=parameters, assignments=assignments)
+    # A real filename and names make tracebacks point at Payment.__init__
+    code = compile(source, f'<generated {__name__}.Payment.__init__>', 'exec')
+    namespace = {}
+    exec(code, {'__name__': __name__}, namespace)
+    init = namespace['__init__']
+    init.__module__ = __name__
+    init.__qualname__ = 'Payment.__init__'
+    return init
+
 class Payment:
     """
     A payment record according to the BPY331 format.
     """
-    def __init__(self, **kwargs: str) -> None:
-        """
-        Initialises a Payment object.  Fields with "NOT SET" are variable and
-        set with details read from the file. Other fields are either static or
-        can be set right away.
-        Args:
-            **kwargs (str): Keyword arguments for the fields that need to be
-            set from the file.
-        """
-        self.defaults = {
-            'interface_source': '"BEN"',
-            'batch_run_id': '"NOT SET"',
-            'posting_ref': '"NOT SET"',
-            'account_ref': '"NOT SET"',
-            'payee_type': '"CL"',
-            'payee_name': '"NOT SET"',
-            'payee_address': '"NOT SET"',
-            'claim_ref': '"NOT SET"',
-            'claimant_name': '"Aggregated DHP UC Payment"',
-            'claimant_adddress': '"Aggregated DHP UC Payment"',
-            'amount': '"amount"',
-            'posting_start_date': f'"{SYSTIME}"',
-            'posting_end_date': f'"{SYSTIME}"',
-            'payment_method': '"BACS"',
-            'creditor_account_ref': '""',
-            'sort_code': '"NOT SET"',
-            'bank_account': '"NOT SET"',
-            'bank_account_name': '"NOT SET"',
-            'building_society_num': '"NOT SET"',
-            'post_office_name': '""',
-            'post_office_address': '""',
-            'collection_flag': '"N"',
-            'document_num': '""',
-            'document_type': '""',
-            'replacement_flag': '"N"',
-            'effective_date': f'"{SYSTIME}"',
-            'blank_one': '""',
-            'blank_two': '""',
-            'document_date': '""'}
-        # Initialises an instance of Payment with default and kwargs values
-        for key, value in self.defaults.items():
-            setattr(self, key, value)
-        for key, value in kwargs.items():
-            setattr(self, key, value)
+    __slots__ = (*PAYMENT_DEFAULTS, '_key')
+    # The order the fields are written to the file in
+    _FIELD_ORDER = tuple(PAYMENT_DEFAULTS)
+
+    __init__ = _generate_init(PAYMENT_DEFAULTS)
 
     def print_payment(self, index: int) -> None:
         """
@@ -104,16 +149,16 @@ class Payment:
             index (int): The index of the Payment object as it would be in the
             file.
         """
-        print(f'--{index}--')
-        items = self.__dict__.items()
-        for key, value in items:
-            if key != 'defaults':
-                # Removing whitespace in the address makes it more readable
-                if key == 'payee_address':
-                    print(value.replace(' ', ''))
-                else:
-                    print(value)
-        print()
+        output = [f'--{index}--']
+        for key in self._FIELD_ORDER:
+            value = getattr(self, key)
+            # Removing whitespace in the address makes it more readable
+            if key == 'payee_address':
+                output.append(value.replace(' ', ''))
+            else:
+                output.append(value)
+        output.extend(('', ''))
+        sys.stdout.write('\n'.join(output))
 
     def get_sql_fields(self) -> dict:
         """
@@ -124,168 +169,166 @@ class Payment:
             (dict): A dictionary with keys of the column names and the values
             of this Payment object.
         """
-        return {
-            'bank_account': self.bank_account[1:-2],
-            'sort_code': self.sort_code[1:-2],
-            'payee_name': self.payee_name[1:-2],
-            'building_society_num': self.building_society_num[1:-2]}
+        return dict(zip(
+            ('bank_account', 'sort_code', 'payee_name',
+             'building_society_num'),
+            self._key))
 
 
-def get_file_name(file_dir: str) -> str:
+def get_file_name(file_dir: str, checked: set) -> str:
     """
     Gets the most-recently modified file in the directory, as long as it
     hasn't been modified in the past 5 minutes and hasn't been aggregated
     before.
     Args:
         file_dir (str): The directory to search.
+        checked (set): The paths of the files that have already been
+        aggregated.
     Returns:
         (str): The path of the most-recently modified file that meets the
         rules. If no files meet the rules, throws a ValueError exception.
     """
-    with open('.\\logs\\already_checked.log', 'r') as already_checked:
-        checked = already_checked.read().splitlines()
-    files_list = []
     now = datetime.datetime.now()
     delta = now - datetime.timedelta(minutes=99999999)
-    for root, _, files in os.walk(file_dir):
-        for file in files:
-            if file.startswith('bpy331_') and file.endswith('.dat'):
-                path = os.path.join(root, file)
-                stats = os.stat(path)
+    newest_path = None
+    newest_modif = None
+    with os.scandir(file_dir) as entries:
+        for entry in entries:
+            name = entry.name
+            if name.startswith('bpy331_') and name.endswith('.dat'):
+                # DirEntry caches the stat, so each file is only stat'd once
+                stats = entry.stat()
                 modif = datetime.datetime.fromtimestamp(stats.st_mtime)
-                if modif > delta and path not in checked:
-                    files_list.append(path)
-    return max(files_list, key=lambda f: os.stat(f).st_mtime)
+                if (modif > delta and entry.path not in checked
+                        and (newest_modif is None or modif > newest_modif)):
+                    newest_path = entry.path
+                    newest_modif = modif
+    if newest_path is None:
+        raise ValueError(f'No unchecked files in {file_dir}')
+    return newest_path
 
-def read_file(filepath: str) -> list:
+def read_file(filepath: str) -> Iterator[str]:
     """
-    Reads a file line-by-line to create a list, with each line as a separate
-    element.
+    Reads a file line-by-line, yielding each line without its line ending so
+    the whole file is never held in memory at once.
     Args:
         filepath (str): The path of the file to read.
-    Returns:
-        (list): A list of strings for each line in the file.
+    Yields:
+        (str): Each line in the file.
     """
-    with open(filepath) as f:
-        lines = f.read().splitlines()
-    return lines
+    with open(filepath, buffering=1 << 20) as f:
+        for line in f:
+            yield line.rstrip('\n')
 
-def create_payments(lines: list) -> list:
+def create_payments(lines: Iterable[str]) -> Iterator[Payment]:
     """
-    Given a list of lines in a file, creates a Payment object for each record.
-    Each record in the file is 29 lines long.
+    Given the lines in a file after the header, creates a Payment object for
+    each record. Each record in the file is 29 lines long.
     Args:
-        lines (list): A list of lines in the file.
-    Returns:
-        (list): A list of Payment objects created from the records in the file.
+        lines (Iterable[str]): The lines in the file, without the header.
+    Yields:
+        (Payment): A Payment object for each record in the file.
     """
-    payments = []
-    for i in range(1, len(lines), 29):
-        payment = Payment(
-            batch_run_id = lines[i + 1],
-            posting_ref = lines[i + 2],
-            payee_name = lines[i + 17],
-            payee_address = lines[i + 6],
-            claim_ref = lines[i + 7],
-            amount = lines[i + 10],
-            sort_code = lines[i + 15],
-            bank_account = lines[i + 16],
-            bank_account_name = lines[i + 17],
-            building_society_num = lines[i + 18])
-        payments.append(payment)
-    return payments
+    lines = iter(lines)
+    while True:
+        record = list(islice(lines, 29))
+        if not record:
+            return
+        yield Payment(
+            batch_run_id = record[1],
+            posting_ref = record[2],
+            payee_name = record[17],
+            payee_address = record[6],
+            claim_ref = record[7],
+            amount = record[10],
+            sort_code = record[15],
+            bank_account = record[16],
+            bank_account_name = record[17],
+            building_society_num = record[18])
 
-def query_payments(connection: pyodbc.Connection, payments: list) -> None:
+def query_payments(
+        connection: pyodbc.Connection, payments: list,
+        upsert_query: str) -> None:
     """
     Queries the SQL database to either get or create the unique reference
     for each Payment object and sets the attribute of the object to that
     reference. Payment object are updated in-place, so we don't need to
     return anything.
     Args:
+        connection (pyodbc.Connection): The connection to the database.
         payments (list): The list of Payment objects to query.
+        upsert_query (str): The query that calls the upsert_payees stored
+        procedure.
     """
-    with open('.\\sql\\insert_query.sql') as insert_f:
-        insert_query = insert_f.read()
-    with open('.\\sql\\select_query.sql') as select_f:
-        select_query = select_f.read()
-    for payment in payments:
-        sql = payment.get_sql_fields()
-        cursor = connection.cursor()
-        # Creates an entry in the database if one doesn't exist
-        cursor.execute(insert_query, (
-            sql['bank_account'], sql['sort_code'], sql['payee_name'],
-            sql['building_society_num'], sql['bank_account'],
-            sql['sort_code'], sql['payee_name'],
-            sql['building_society_num']))
+    # Many payments share a payee, so only send each set of fields once
+    keys = list({payment._key for payment in payments})
+    if not keys:
+        return
+    # Runs the upsert as a single transaction that is committed once
+    connection.autocommit = False
+    cursor = connection.cursor()
+    try:
+        # Creates an entry in the database for each key that doesn't exist
+        # and gets the account reference for every key in one round-trip
+        cursor.execute(upsert_query, (keys,))
+        # Quotes each reference once, so every Payment for a payee shares it
+        refs = {tuple(key): f'"{ref}"' for *key, ref in cursor.fetchall()}
         connection.commit()
-        # Gets the account reference from the database
-        cursor.execute(select_query, (
-            sql['bank_account'], sql['sort_code'], sql['payee_name'],
-            sql['building_society_num']))
-        payment.account_ref = f'"{cursor.fetchone()[0]}"'
-
-def group_payments(payments: list) -> dict:
-    """
-    Groups together Payment objects with the same account reference into
-    a dictionary.
-    Args:
-        payments (list): The list of Payment objects to group.
-    Returns:
-        (dict): A dictionary with each account reference as a key and a
-        list of the Payment objects with that account reference as its
-        value.
-    """
-    groups = {}
+    except pyodbc.Error:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
     for payment in payments:
-        groups.setdefault(payment.account_ref, []).append(payment)
-    return groups
+        payment.account_ref = refs[payment._key]
 
-def print_formatted_groups(groups: dict) -> None:
+def sum_payments(payments: list) -> list:
     """
-    Formats and prints the groups dictionary with each key on a separate line.
+    Sums up the amount of every Payment object with the same account
+    reference in a single pass, and creates a new Payment object for each
+    account reference with the amount field set to that total. Every other
+    field apart from the amount field is identical for each account
+    reference, so just take the first (or possibly only) Payment object for
+    those fields.
     Args:
-        groups (dict): The groups dictionary to be printed out.
-    """
-    for key, payments in groups.items():
-        amount = len(payments)
-        name = payments[0].payee_name
-        print(f'{key}: {amount} instance(s) of {name}')
-
-def sum_payments(groups: dict) -> list:
-    """
-    Iterates over the groups dictionary and creates a new Payment object
-    for each key, with the amount field set to the summation of every amount
-    belonging to that key. Every other field apart from the amount field is
-    identical for each key, so just take the first (or possibly only) element
-    in that list for those fields.
-    Args:
-        groups (dict): The Payment objects grouped by account reference.
+        payments (list): The Payment objects with account references set.
     Returns:
-        (list): One Payment object for each key with the total amount for all
-        Payment objects belonging to that key.
+        (list): One Payment object for each account reference with the total
+        amount for all Payment objects with that account reference.
     """
+    # Maps each account reference to its running total and first Payment
+    totals = {}
+    for payment in payments:
+        # Amounts are summed in whole pennies so totals are exact
+        pennies = round(float(payment.amount.rstrip()[1:-1]) * 100)
+        entry = totals.get(payment.account_ref)
+        if entry is None:
+            totals[payment.account_ref] = [pennies, payment]
+        else:
+            entry[0] += pennies
     summed_payments = []
-    for _, payments in groups.items():
-        total = 0
-        for payment in payments:
-            amount = float(payment.amount[1:-2])
-            total += amount
-        str_total = '"{0:.2f}"'.format(total)
+    for total, first in totals.values():
+        pounds, pence = divmod(abs(total), 100)
+        sign = '-' if total < 0 else ''
+        str_total = f'"{sign}{pounds}.{pence:02d}"'
         summed_payments.append(Payment(
-            batch_run_id = payments[0].batch_run_id,
-            posting_ref = payments[0].posting_ref,
-            account_ref = payments[0].account_ref,
-            payee_name = payments[0].payee_name,
-            payee_address = payments[0].payee_address,
-            claim_ref = payments[0].claim_ref,
+            batch_run_id = first.batch_run_id,
+            posting_ref = first.posting_ref,
+            account_ref = first.account_ref,
+            payee_name = first.payee_name,
+            payee_address = first.payee_address,
+            claim_ref = first.claim_ref,
             amount = str_total,
-            sort_code = payments[0].sort_code,
-            bank_account = payments[0].bank_account,
-            bank_account_name = payments[0].bank_account_name,
-            building_society_num = payments[0].building_society_num))
+            sort_code = first.sort_code,
+            bank_account = first.bank_account,
+            bank_account_name = first.bank_account_name,
+            building_society_num = first.building_society_num))
     return summed_payments
 
-def write_payments(path: str, backup: str, summed_payments: list) -> str:
+def write_payments(
+        path: str, backup: str, summed_payments: list, header: str,
+        checked: set, checked_log: TextIO, payments_log: TextIO,
+        write_time: str) -> str:
     """
     Writes a list of Payment objects to a file in the same format as the file
     they were read from.
@@ -294,32 +337,57 @@ def write_payments(path: str, backup: str, summed_payments: list) -> str:
         file we read from in load_files())
         backup (str): The path to back the files up to
         new_payments (list): A list of Payment objects to write to file
+        header (str): The header line of the original file
+        checked (set): The paths of the files that have already been
+        aggregated, which the path is added to
+        checked_log (TextIO): The open already checked log
+        payments_log (TextIO): The open payments log
+        write_time (str): The time the run started, for the payments log
     Returns:
         (str): A string indicating the file written to and the amount of
         Payment objects in the file
     """
     # delete after testing
-    temp_new_file = f.replace('\\data', '\\new')
+    temp_new_file = path.replace('\\data', '\\new')
     count = 0
-    # Backs up the original file
     os.makedirs(os.path.dirname(backup), exist_ok=True)
-    shutil.copy2(path, backup)
-    # Gets the header from the original file
-    with open(path, 'r') as read:
-        header = read.read().splitlines()[0]
-    with open(temp_new_file, 'w') as write:
-        write.write('{}\n'.format(header))
+    # The new file is written next to the one it replaces, so the original
+    # can be backed up at the same time
+    temp_path = temp_new_file + '.tmp'
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        # Backs up the original file while the new one is written
+        backup_future = executor.submit(shutil.copy2, path, backup)
+        # Builds the whole file up front so it can be written in one go
+        output = [header]
         for payment in summed_payments:
-            for key, value in payment.__dict__.items():
-                if key != 'defaults':
-                    write.write(f'{value}\n')
+            output.extend(
+                getattr(payment, key) for key in Payment._FIELD_ORDER)
             count += 1
-    # Logs the file so it isn't aggregated again
-    with open('.\\logs\\already_checked.log', 'a') as already_checked:
-        already_checked.write('{}\n'.format(path))
-    success_string = f'{WRITETIME} - Successfully written {count}/{len(summed_payments)} payments to {path}\n'
-    with open('.\\logs\\payments.log', 'a') as log:
-        log.write(success_string)
+        output.append('')
+        try:
+            with open(temp_path, 'w', buffering=1 << 20) as write:
+                write.write('\n'.join(output))
+                # The file must be on disk before it's logged as checked, or
+                # a crash could lose it while it's skipped from then on
+                write.flush()
+                os.fsync(write.fileno())
+            # The original can't be replaced until it has been backed up
+            backup_future.result()
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+    # Swaps the new file in atomically, so a crash leaves either the whole
+    # original or the whole new file
+    os.replace(temp_path, temp_new_file)
+    success_string = f'{write_time} - Successfully written {count}/{len(summed_payments)} payments to {path}\n'
+    # Logs the file so it isn't aggregated again, then makes sure both log
+    # lines have reached the disk together
+    checked.add(path)
+    checked_log.write('{}\n'.format(path))
+    payments_log.write(success_string)
+    os.fsync(checked_log.fileno())
+    os.fsync(payments_log.fileno())
     return success_string
 
 def send_email(path: str, success_string: str) -> None:
@@ -341,10 +409,18 @@ def send_email(path: str, success_string: str) -> None:
 
 
 if __name__ == '__main__':
-    SYSTIME = datetime.date.today().strftime('%d-%b-%Y').upper()
     WRITETIME = datetime.datetime.now().strftime('%d-%b-%Y %H:%M:%S')
+    # Set AGG_DEBUG=1 to print the aggregated payments to the console
+    DEBUG = os.environ.get('AGG_DEBUG') == '1'
+    # Opens the logs once for the whole run, flushing after every line. The
+    # already checked log is also read from, so it's opened with a+
+    PAYMENTS_LOG = open('.\\logs\\payments.log', 'a', buffering=1)
+    ALREADY_CHECKED_LOG = open(
+        '.\\logs\\already_checked.log', 'a+', buffering=1)
     with open('.\\.config') as config_f:
         config = json.load(config_f)
+    with open('.\\sql\\upsert_query.sql') as upsert_f:
+        UPSERT_QUERY = upsert_f.read()
     # Attempts to connect to the SQL database
     try:
         DB_CONN = pyodbc.connect(
@@ -355,23 +431,27 @@ if __name__ == '__main__':
             pwd=config['pwd'])
     except pyodbc.InterfaceError as error:
         # Writes to log with current time and error
-        with open('.\\logs\\payments.log', 'a') as log:
-            log.write(f'{WRITETIME} - {error}\n')
+        PAYMENTS_LOG.write(f'{WRITETIME} - {error}\n')
         sys.exit(1)
+    # Loads the files that have already been aggregated
+    ALREADY_CHECKED_LOG.seek(0)
+    CHECKED = set(ALREADY_CHECKED_LOG.read().splitlines())
     # Attempts to open the most recent file
     try:
-        f = get_file_name('.\\data')
+        f = get_file_name('.\\data', CHECKED)
     except ValueError:
         # Writes to log with just the current time
-        with open('.\\logs\\payments.log', 'a') as log:
-            log.write(f'{WRITETIME}\n')
+        PAYMENTS_LOG.write(f'{WRITETIME}\n')
         sys.exit(1)
     lines = read_file(f)
-    payments = create_payments(lines)
-    query_payments(DB_CONN, payments)
-    groups = group_payments(payments)
-    summed_payments = sum_payments(groups)
-    for index, payment in enumerate(summed_payments):
-        payment.print_payment(index)
+    header = next(lines)
+    payments = list(create_payments(lines))
+    query_payments(DB_CONN, payments, UPSERT_QUERY)
+    summed_payments = sum_payments(payments)
+    if DEBUG:
+        for index, payment in enumerate(summed_payments):
+            payment.print_payment(index)
     archive = f.replace('\\data', '\\archive')
-    write_payments(f, archive, summed_payments)
+    write_payments(
+        f, archive, summed_payments, header, CHECKED, ALREADY_CHECKED_LOG,
+        PAYMENTS_LOG, WRITETIME)
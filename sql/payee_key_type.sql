@@ -0,0 +1,5 @@
+CREATE TYPE PayeeKey AS TABLE (
+	bank_account NVARCHAR(32),
+	sort_code NVARCHAR(16),
+	payee_name NVARCHAR(128),
+	building_society_num NVARCHAR(32))
\ No newline at end of file
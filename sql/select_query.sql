@@ -1,5 +0,0 @@
-SELECT id FROM Payments
-	WHERE bank_account = ?
-	AND sort_code = ?
-	AND payee_name = ?
-	AND building_society_num = ?
\ No newline at end of file
@@ -0,0 +1,40 @@
+CREATE PROCEDURE upsert_payees
+	@keys PayeeKey READONLY
+AS
+BEGIN
+	SET NOCOUNT ON;
+	-- Keys that only differ by case or trailing spaces are the same payee
+	MERGE Payments WITH (HOLDLOCK) AS Target
+	USING (
+		SELECT DISTINCT bank_account,
+			sort_code,
+			payee_name,
+			building_society_num
+		FROM @keys) AS Source
+		ON Target.bank_account = Source.bank_account
+		AND Target.sort_code = Source.sort_code
+		AND Target.payee_name = Source.payee_name
+		AND Target.building_society_num = Source.building_society_num
+	WHEN NOT MATCHED THEN
+		INSERT (
+			bank_account,
+			sort_code,
+			payee_name,
+			building_society_num)
+		VALUES (
+			Source.bank_account,
+			Source.sort_code,
+			Source.payee_name,
+			Source.building_society_num);
+	SELECT Keys.bank_account,
+		Keys.sort_code,
+		Keys.payee_name,
+		Keys.building_society_num,
+		Payments.id
+	FROM @keys AS Keys
+		INNER JOIN Payments
+		ON Payments.bank_account = Keys.bank_account
+		AND Payments.sort_code = Keys.sort_code
+		AND Payments.payee_name = Keys.payee_name
+		AND Payments.building_society_num = Keys.building_society_num;
+END
\ No newline at end of file
@@ -0,0 +1 @@
+{CALL upsert_payees (?)}
\ No newline at end of file
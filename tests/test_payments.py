@@ -2,8 +2,13 @@
 Verifies the aggregate payment output is correct
 """
 
+import os
+import tempfile
 import unittest
 
+from aggregate_payments import (
+    PAYMENT_DEFAULTS, Payment, sum_payments, write_payments)
+
 class TestPayments(unittest.TestCase):
     """
     Tests payments for data file bpy331_1487931_7163.1.dat have been
@@ -59,5 +64,111 @@ class TestPayments(unittest.TestCase):
         payments = [3025.0]
         self.assertAlmostEqual(sum(payments), 3025.0, places=2)
 
+
+class TestSumPayments(unittest.TestCase):
+    """
+    Tests sum_payments() totals the amount fields of each account reference
+    exactly and formats them to 2 decimal places
+    """
+
+    def sum_amounts(self, amounts: list) -> str:
+        """
+        Sums amounts for a single account reference, with each amount
+        formatted as it is in the file (quoted with trailing whitespace)
+        """
+        payments = [
+            Payment(account_ref='"1"', amount=f'"{amount}" ')
+            for amount in amounts]
+        summed_payments = sum_payments(payments)
+        self.assertEqual(len(summed_payments), 1)
+        return summed_payments[0].amount
+
+    def test_first_payment_aggregation(self):
+        """
+        Tests payments to "MRS RV O'DRISCROLL/##-##-##/########"
+        """
+        amounts = ['535.71', '232.57', '465.01', '143.08', '4095.00']
+        self.assertEqual(self.sum_amounts(amounts), '"5471.37"')
+
+    def test_second_payment_aggregation(self):
+        """
+        Tests payments to
+        "BROADACRES HOUSING ASSOCIATION/##-##-##/########"
+        """
+        amounts = [
+            '1503.33', '891.00', '422.13', '42.15', '166.59', '73.98',
+            '95.12', '1922.78', '38.79', '140.38', '786.33', '41.76',
+            '81.53', '33.75', '43.39', '212.97', '415.80', '142.14',
+            '87.99', '531.25', '528.90']
+        self.assertEqual(self.sum_amounts(amounts), '"8202.06"')
+
+    def test_sub_pound_aggregation(self):
+        """
+        Tests a total of less than a pound keeps its leading zeros
+        """
+        self.assertEqual(self.sum_amounts(['0.02', '0.03']), '"0.05"')
+
+    def test_negative_aggregation(self):
+        """
+        Tests a negative total keeps its sign
+        """
+        self.assertEqual(self.sum_amounts(['0.25', '-1.50']), '"-1.25"')
+        self.assertEqual(self.sum_amounts(['0.25', '-0.30']), '"-0.05"')
+
+    def test_separate_account_refs(self):
+        """
+        Tests each account reference gets its own total, in the order they
+        first appear
+        """
+        payments = [
+            Payment(account_ref='"1"', amount='"1.10" '),
+            Payment(account_ref='"2"', amount='"2.20" '),
+            Payment(account_ref='"1"', amount='"3.30" ')]
+        summed = [
+            (payment.account_ref, payment.amount)
+            for payment in sum_payments(payments)]
+        self.assertEqual(summed, [('"1"', '"4.40"'), ('"2"', '"2.20"')])
+
+
+class TestWritePayments(unittest.TestCase):
+    """
+    Tests write_payments() backs up the original file, replaces it with the
+    aggregated payments and logs the file as checked
+    """
+
+    def test_write_payments(self):
+        """
+        Tests the new file, the backup and both log lines
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'bpy331_1.dat')
+            backup = os.path.join(tmp, 'archive', 'bpy331_1.dat')
+            with open(path, 'w') as original:
+                original.write('"HEADER" \n"OLD" \n')
+            payment = Payment(account_ref='"1"', amount='"4.40"')
+            checked = set()
+            checked_path = os.path.join(tmp, 'checked.log')
+            payments_path = os.path.join(tmp, 'payments.log')
+            with open(checked_path, 'a+') as checked_log, \
+                    open(payments_path, 'a+') as payments_log:
+                success_string = write_payments(
+                    path, backup, [payment], '"HEADER" ', checked,
+                    checked_log, payments_log, 'NOW')
+                checked_log.seek(0)
+                payments_log.seek(0)
+                self.assertEqual(checked_log.read(), f'{path}\n')
+                self.assertEqual(payments_log.read(), success_string)
+            self.assertEqual(
+                success_string,
+                f'NOW - Successfully written 1/1 payments to {path}\n')
+            self.assertEqual(checked, {path})
+            with open(path) as new:
+                self.assertEqual(new.read().splitlines(), [
+                    '"HEADER" ',
+                    *(getattr(payment, key) for key in PAYMENT_DEFAULTS)])
+            with open(backup) as old:
+                self.assertEqual(old.read(), '"HEADER" \n"OLD" \n')
+            self.assertFalse(os.path.exists(path + '.tmp'))
+
 if __name__ == '__main__':
     unittest.main()